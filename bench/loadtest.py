@@ -0,0 +1,467 @@
+# bench/loadtest.py
+"""End-to-end load test for the bot.
+
+Starts main.py as a subprocess pointed at local stand-ins for the Telegram Bot API,
+OpenRouter /chat/completions and OCR.space, then replays simulated students
+(/start, /task, /gettask + callbacks, photos) and one owner /broadcast.
+
+Reports throughput, p50/p95/p99 latency per handler and RSS growth of the bot process.
+
+    python bench/loadtest.py --students 2000 --concurrency 200 --ai-latency 0.3 --ai-error-rate 0.02
+    python bench/loadtest.py --students 500 --json bench_output.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PY = os.path.join(ROOT, "main.py")
+TOKEN = "123456:LOADTEST"
+OWNER_ID = 1
+BOT_USER = {
+    "id": 42, "is_bot": True, "first_name": "LoadBot", "username": "load_bot",
+    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+# Ответы бота с этими префиксами — промежуточные ("Решаю задачу..."), шаг ещё не завершён
+INTERIM_PREFIXES = ("🔍", "🔎 Пытаюсь", "🔎 Решаю", "🧾")
+# Сообщения рассылки приходят всем ученикам и не являются ответом на их шаг
+BROADCAST_PREFIX = "📢 Сообщение от учителя"
+# Пересылки учителю (фото ученика без распознанного текста, скриншоты оплаты) приходят в чат владельца
+# и не являются ответом на его шаг (/broadcast)
+TEACHER_FORWARD_PREFIXES = ("📩 От ученика", "💳 Скриншот оплаты")
+FAKE_PHOTO = bytes(random.getrandbits(8) for _ in range(20_000))
+FAKE_OCR_TEXT = "Решите уравнение:\r\n2x + 5 = 17\r\n|||\r\nНайдите x"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[k]
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Upstream:
+    """Configurable latency / error injection shared by the OpenRouter and OCR stubs."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+
+    async def delay(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    def should_fail(self) -> bool:
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+class FakeServer:
+    def __init__(self, ai: Upstream, ocr: Upstream):
+        self.ai = ai
+        self.ocr = ocr
+        self.updates = asyncio.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        self.pending = {}       # chat_id -> asyncio.Future, завершается финальным ответом бота
+        self.keyboards = {}     # chat_id -> (message, inline_keyboard) последнего сообщения с кнопками
+        self.method_calls = {}
+        self.broadcast_received = 0
+        self.teacher_forwards = 0
+        self.polling_started = asyncio.Event()
+
+    # ---------- helpers ----------
+    def _next_message_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    def _chat(self, chat_id):
+        return {"id": chat_id, "type": "private", "first_name": f"Student{chat_id}"}
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Student{user_id}", "username": f"student{user_id}"}
+
+    def _bot_message(self, chat_id, text=None, caption=None, message_id=None):
+        msg = {"message_id": message_id or self._next_message_id(), "date": int(time.time()),
+               "chat": self._chat(chat_id), "from": BOT_USER}
+        if text is not None:
+            msg["text"] = text
+        if caption is not None:
+            msg["caption"] = caption
+        return msg
+
+    def push_update(self, chat_id, payload):
+        self.update_id += 1
+        payload["update_id"] = self.update_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[chat_id] = future
+        self.updates.put_nowait(payload)
+        return future
+
+    def user_message(self, chat_id, **fields):
+        msg = {"message_id": self._next_message_id(), "date": int(time.time()),
+               "chat": self._chat(chat_id), "from": self._user(chat_id)}
+        msg.update(fields)
+        return msg
+
+    def command(self, chat_id, text):
+        cmd_len = len(text.split()[0])
+        return self.push_update(chat_id, {"message": self.user_message(
+            chat_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": cmd_len}])})
+
+    def text(self, chat_id, text):
+        return self.push_update(chat_id, {"message": self.user_message(chat_id, text=text)})
+
+    def photo(self, chat_id, file_id, media_group_id=None):
+        fields = {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 800,
+                             "height": 600, "file_size": len(FAKE_PHOTO)}]}
+        if media_group_id:
+            fields["media_group_id"] = media_group_id
+        return self.push_update(chat_id, {"message": self.user_message(chat_id, **fields)})
+
+    def click(self, chat_id, pick):
+        """Нажимает кнопку из последней клавиатуры, которую бот прислал в чат. pick(buttons) -> button."""
+        message, keyboard = self.keyboards.get(chat_id, (None, None))
+        buttons = [b for row in keyboard or [] for b in row if "callback_data" in b]
+        if not buttons:
+            return None
+        button = pick(buttons)
+        return self.push_update(chat_id, {"callback_query": {
+            "id": str(self.update_id + 1), "from": self._user(chat_id), "chat_instance": str(chat_id),
+            "data": button["callback_data"], "message": message}})
+
+    def _on_bot_message(self, chat_id, message, markup):
+        if markup and markup.get("inline_keyboard"):
+            self.keyboards[chat_id] = (message, markup["inline_keyboard"])
+        text = message.get("text") or message.get("caption") or ""
+        if text.startswith(BROADCAST_PREFIX):
+            self.broadcast_received += 1
+            return
+        if text.startswith(INTERIM_PREFIXES):
+            return
+        if text.startswith(TEACHER_FORWARD_PREFIXES):
+            self.teacher_forwards += 1
+            return
+        future = self.pending.pop(chat_id, None)
+        if future and not future.done():
+            future.set_result(text)
+
+    # ---------- Bot API ----------
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        self.method_calls[method] = self.method_calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        for key in ("reply_markup", "media"):
+            if isinstance(params.get(key), str):
+                params[key] = json.loads(params[key])
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        result = True
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            self.polling_started.set()
+            timeout = float(params.get("timeout") or 0)
+            batch = []
+            try:
+                batch.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+            except asyncio.TimeoutError:
+                pass
+            while batch and not self.updates.empty() and len(batch) < 100:
+                batch.append(self.updates.get_nowait())
+            result = batch
+        elif method in ("sendMessage", "editMessageText"):
+            message_id = int(params["message_id"]) if method == "editMessageText" else None
+            result = self._bot_message(chat_id, text=params.get("text", ""), message_id=message_id)
+            self._on_bot_message(chat_id, result, params.get("reply_markup"))
+        elif method in ("sendPhoto", "sendDocument"):
+            result = self._bot_message(chat_id, caption=params.get("caption") or "")
+            if method == "sendDocument":
+                result["document"] = {"file_id": "doc", "file_unique_id": "doc", "file_name": "answer.txt"}
+            else:
+                result["photo"] = [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]
+            self._on_bot_message(chat_id, result, params.get("reply_markup"))
+        elif method == "sendMediaGroup":
+            result = [self._bot_message(chat_id, caption="") for _ in params.get("media") or []]
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(FAKE_PHOTO),
+                      "file_path": f"photos/{file_id}.jpg"}
+        return web.json_response({"ok": True, "result": result})
+
+    async def file_download(self, request):
+        return web.Response(body=FAKE_PHOTO, content_type="image/jpeg")
+
+    # ---------- OpenRouter / OCR stubs ----------
+    async def chat_completions(self, request):
+        payload = await request.json()
+        await self.ai.delay()
+        if self.ai.should_fail():
+            if random.random() < 0.5:
+                return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+            return web.json_response({"error": "upstream error"}, status=502)
+        prompt = payload["messages"][-1]["content"]
+        answer = "Шаг 1. Переносим 5 вправо.\nШаг 2. Делим на 2.\nОтвет: x = 6."
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": answer}}],
+            "usage": {"prompt_tokens": len(prompt) // 3, "completion_tokens": len(answer) // 3},
+        })
+
+    async def ocr_parse(self, request):
+        await request.read()
+        await self.ocr.delay()
+        if self.ocr.should_fail():
+            return web.json_response({"error": "ocr unavailable"}, status=503)
+        return web.json_response({"IsErroredOnProcessing": False,
+                                  "ParsedResults": [{"ParsedText": FAKE_OCR_TEXT}]})
+
+    def make_app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file_download)
+        app.router.add_post("/api/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/parse/image", self.ocr_parse)
+        return app
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.timeouts = {}
+
+    def add(self, handler, seconds):
+        self.latencies.setdefault(handler, []).append(seconds)
+
+    def timeout(self, handler):
+        self.timeouts[handler] = self.timeouts.get(handler, 0) + 1
+
+
+async def step(server, stats, handler, future, step_timeout):
+    if future is None:
+        return False
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(future, timeout=step_timeout)
+    except asyncio.TimeoutError:
+        stats.timeout(handler)
+        return False
+    stats.add(handler, time.perf_counter() - started)
+    return True
+
+
+async def run_student(server, stats, chat_id, actions, step_timeout, album_size):
+    await step(server, stats, "start", server.command(chat_id, "/start"), step_timeout)
+    for i in range(actions):
+        kind = random.choices(["task", "gettask", "photo"], weights=[3, 4, 3])[0]
+        if kind == "task":
+            await step(server, stats, "task", server.command(chat_id, "/task Решите уравнение 2x + 5 = 17"), step_timeout)
+        elif kind == "gettask":
+            if not await step(server, stats, "gettask", server.command(chat_id, "/gettask"), step_timeout):
+                continue
+            if not await step(server, stats, "tasksub", server.click(chat_id, random.choice), step_timeout):
+                continue
+            if not await step(server, stats, "tasktopic", server.click(chat_id, random.choice), step_timeout):
+                continue
+            if random.random() < 0.5:
+                await step(server, stats, "solve_now", server.click(chat_id, lambda b: b[0]), step_timeout)
+        elif album_size > 1 and random.random() < 0.3:
+            group = f"album-{chat_id}-{i}"
+            future = None
+            for page in range(album_size):
+                future = server.photo(chat_id, f"{group}-{page}", media_group_id=group)
+            await step(server, stats, "album", future, step_timeout)
+        else:
+            await step(server, stats, "photo", server.photo(chat_id, f"photo-{chat_id}-{i}"), step_timeout)
+
+
+async def run_broadcast(server, stats, delay, step_timeout):
+    await asyncio.sleep(delay)
+    await step(server, stats, "broadcast_command", server.command(OWNER_ID, "/broadcast"), step_timeout)
+    await step(server, stats, "broadcast", server.text(OWNER_ID, "Завтра контрольная по алгебре!"), step_timeout)
+
+
+async def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        rss = read_rss_kb(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main_async(args):
+    ai = Upstream(args.ai_latency, args.ai_error_rate)
+    ocr = Upstream(args.ocr_latency, args.ocr_error_rate)
+    server = FakeServer(ai, ocr)
+    runner = web.AppRunner(server.make_app(), access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    base = f"http://127.0.0.1:{port}"
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": TOKEN,
+        "OWNER_IDS": str(OWNER_ID),
+        "OPENROUTER_API_KEY": "loadtest",
+        "OCR_API_KEY": "loadtest",
+        "FREE_DAILY_LIMIT": "1000000",
+        "TELEGRAM_API_BASE_URL": f"{base}/bot",
+        "TELEGRAM_FILE_BASE_URL": f"{base}/file/bot",
+        "OPENROUTER_API_URL": f"{base}/api/v1/chat/completions",
+        "OCR_API_URL": f"{base}/parse/image",
+        "PORT": str(free_port()),
+    })
+    env.pop("REPL_SLUG", None)
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, MAIN_PY], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await asyncio.wait_for(server.polling_started.wait(), timeout=args.startup_timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        raise SystemExit(f"Bot did not start polling within {args.startup_timeout}s, see {log.name}")
+    startup_seconds = time.perf_counter() - started
+
+    rss_samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(proc.pid, rss_samples, stop))
+    rss_start = read_rss_kb(proc.pid)
+
+    stats = Stats()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(chat_id):
+        async with semaphore:
+            await run_student(server, stats, chat_id, args.actions, args.step_timeout, args.album_size)
+
+    t0 = time.perf_counter()
+    students = [limited(OWNER_ID + 1 + i) for i in range(args.students)]
+    broadcast = run_broadcast(server, stats, args.broadcast_delay, args.step_timeout)
+    await asyncio.gather(*students, broadcast)
+    elapsed = time.perf_counter() - t0
+
+    rss_end = read_rss_kb(proc.pid)
+    stop.set()
+    await sampler
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    log.close()
+    await runner.cleanup()
+
+    completed = sum(len(v) for v in stats.latencies.values())
+    handlers = {}
+    for handler in sorted(set(stats.latencies) | set(stats.timeouts)):
+        values = stats.latencies.get(handler, [])
+        handlers[handler] = {
+            "count": len(values),
+            "timeouts": stats.timeouts.get(handler, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 1) if values else None,
+            "p95_ms": round(percentile(values, 95) * 1000, 1) if values else None,
+            "p99_ms": round(percentile(values, 99) * 1000, 1) if values else None,
+        }
+    return {
+        "config": vars(args),
+        "startup_seconds": round(startup_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "completed_steps": completed,
+        "throughput_per_second": round(completed / elapsed, 2) if elapsed else None,
+        "handlers": handlers,
+        "rss_kb": {
+            "start": rss_start,
+            "end": rss_end,
+            "peak": max(rss_samples) if rss_samples else None,
+            "growth": rss_end - rss_start if rss_start and rss_end else None,
+        },
+        "upstream_calls": {"ai": ai.calls, "ai_errors": ai.errors, "ocr": ocr.calls, "ocr_errors": ocr.errors},
+        "bot_api_calls": server.method_calls,
+        "broadcast_received": server.broadcast_received,
+        "teacher_forwards": server.teacher_forwards,
+        "bot_log": log.name,
+    }
+
+
+def print_report(report):
+    print(f"Startup: {report['startup_seconds']} s, run: {report['elapsed_seconds']} s, "
+          f"throughput: {report['throughput_per_second']} steps/s ({report['completed_steps']} steps)")
+    print(f"{'handler':<18}{'count':>8}{'timeouts':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, h in report["handlers"].items():
+        print(f"{name:<18}{h['count']:>8}{h['timeouts']:>10}{str(h['p50_ms']):>10}{str(h['p95_ms']):>10}{str(h['p99_ms']):>10}")
+    rss = report["rss_kb"]
+    print(f"RSS KB: start={rss['start']} end={rss['end']} peak={rss['peak']} growth={rss['growth']}")
+    print(f"Upstreams: {report['upstream_calls']}, broadcast delivered: {report['broadcast_received']}")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--students", type=int, default=1000)
+    p.add_argument("--actions", type=int, default=5, help="actions per student after /start")
+    p.add_argument("--concurrency", type=int, default=100, help="students active at the same time")
+    p.add_argument("--album-size", type=int, default=0, help="pages per album; 0 disables albums")
+    p.add_argument("--ai-latency", type=float, default=0.2, help="mean OpenRouter stub latency, s")
+    p.add_argument("--ai-error-rate", type=float, default=0.0)
+    p.add_argument("--ocr-latency", type=float, default=0.3, help="mean OCR stub latency, s")
+    p.add_argument("--ocr-error-rate", type=float, default=0.0)
+    p.add_argument("--broadcast-delay", type=float, default=5.0, help="seconds before the owner broadcasts")
+    p.add_argument("--step-timeout", type=float, default=120.0)
+    p.add_argument("--startup-timeout", type=float, default=60.0)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--json", help="write the report as JSON to this path")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
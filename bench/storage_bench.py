@@ -0,0 +1,221 @@
+# bench/storage_bench.py
+"""Storage micro-benchmarks for UserDataManager.
+
+Generates synthetic user databases (with referrals) and measures:
+  * _load_data time and peak Python memory (tracemalloc)
+  * save() latency and bytes written
+  * get_all() deepcopy cost
+  * write amplification of a /task request (saves and bytes written per request)
+
+Results are printed as JSON (or written to --output) so runs can be diffed across versions.
+
+    python bench/storage_bench.py --sizes 1000,10000,100000,1000000 --output bench_output.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_main(workdir):
+    # При импорте main.py начинает фоновую загрузку user_data.json и пишет task_ids.json в текущую
+    # директорию — импортируем из пустой. INFO-логи импорта (банк задач и т.п.) в stderr не нужны.
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sys.path.insert(0, ROOT)
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+def make_user(rng, today, with_premium):
+    return {
+        "full_name": f"Ученик {rng.randrange(10**6)}",
+        "username": f"user{rng.randrange(10**9)}",
+        "subject": rng.choice([None, "math", "english", "history", "literature"]),
+        "free_uses_today": rng.randrange(6),
+        "last_free_date": rng.choice([today, "2024-01-01"]),
+        "premium_until": int(time.time()) + rng.randrange(1, 90) * 86400 if with_premium else 0,
+        "referrer": None,
+        "referrals": [],
+    }
+
+
+def generate_users(count, seed=0):
+    rng = random.Random(seed)
+    today = datetime.date.today().isoformat()
+    ids = [str(100_000_000 + i * 7 + rng.randrange(7)) for i in range(count)]
+    data = {}
+    for i, uid in enumerate(ids):
+        user = make_user(rng, today, with_premium=rng.random() < 0.05)
+        # ~30% пришли по реферальной ссылке от более раннего пользователя
+        if i and rng.random() < 0.3:
+            referrer = ids[rng.randrange(i)]
+            user["referrer"] = referrer
+            data[referrer]["referrals"].append(uid)
+        data[uid] = user
+    return data
+
+
+def timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples), result
+
+
+def fresh_manager(main):
+    main.UserDataManager._instance = None
+    manager = main.UserDataManager()
+    manager.wait_ready()
+    return manager
+
+
+def task_flow(manager, uid, user):
+    # Те же вызовы user_manager, что делает task_command (без сетевой части)
+    manager.ensure_user(uid, user.full_name, user.username)
+    if manager.can_use_free(uid):
+        manager.use_free(uid)
+
+
+class FakeUser:
+    def __init__(self, full_name, username):
+        self.full_name = full_name
+        self.username = username
+
+
+def measure_task_flow(main, manager, uid, user):
+    saves = []
+    original_save = manager.save
+
+    def counting_save():
+        saves.append(1)
+        original_save()
+
+    manager.save = counting_save
+    try:
+        started = time.perf_counter()
+        task_flow(manager, uid, user)
+        seconds = time.perf_counter() - started
+    finally:
+        del manager.save
+    file_bytes = os.path.getsize(main.USER_DATA_FILE)
+    record_bytes = len(json.dumps({uid: manager.get(uid)}, indent=2, ensure_ascii=False).encode("utf-8"))
+    return {
+        "seconds": seconds,
+        "saves": len(saves),
+        "bytes_written": len(saves) * file_bytes,
+        "record_bytes": record_bytes,
+        "write_amplification": round(len(saves) * file_bytes / record_bytes, 1),
+    }
+
+
+def bench_size(main, workdir, count, repeat, seed):
+    data = generate_users(count, seed)
+    path = os.path.join(workdir, f"user_data_{count}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    del data
+    main.USER_DATA_FILE = path
+    main.BACKUP_FILE = path + ".bak"
+    file_bytes = os.path.getsize(path)
+
+    load_seconds, _ = timed(main.UserDataManager._load_data, repeat)
+    tracemalloc.start()
+    loaded = main.UserDataManager._load_data()
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+
+    manager = fresh_manager(main)
+    save_seconds, _ = timed(manager.save, repeat)
+    save_bytes = os.path.getsize(path)
+
+    get_all_seconds, _ = timed(manager.get_all, repeat)
+
+    existing_uid = next(iter(manager.data))
+    existing = manager.get(existing_uid)
+    # Первый запрос за день (сброс счётчика), повторный запрос и запрос нового пользователя
+    existing["last_free_date"] = ""
+    first_of_day = measure_task_flow(main, manager, existing_uid, FakeUser(existing["full_name"], existing["username"]))
+    repeat_request = measure_task_flow(main, manager, existing_uid, FakeUser(existing["full_name"], existing["username"]))
+    new_user = measure_task_flow(main, manager, "999999999999", FakeUser("Новый ученик", "new_user"))
+
+    for p in (path, path + ".bak"):
+        if os.path.exists(p):
+            os.remove(p)
+    return {
+        "users": count,
+        "file_bytes": file_bytes,
+        "load": {"seconds": load_seconds, "peak_bytes": load_peak},
+        "save": {"seconds": save_seconds, "bytes_written": save_bytes},
+        "get_all": {"seconds": get_all_seconds},
+        "task_flow": {
+            "existing_user_first_of_day": first_of_day,
+            "existing_user_repeat": repeat_request,
+            "new_user": new_user,
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", default="1000,10000,100000,1000000", help="comma-separated user counts")
+    p.add_argument("--repeat", type=int, default=3, help="runs per timing, median is reported")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--output", help="write JSON here instead of stdout")
+    args = p.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="storage-bench-")
+    main = import_main(workdir)
+    main.logger.disabled = True
+    results = []
+    for count in (int(x) for x in args.sizes.split(",")):
+        print(f"benchmarking {count} users...", file=sys.stderr)
+        results.append(bench_size(main, workdir, count, args.repeat, args.seed))
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,19 +1,29 @@
 # bot_complete.py
+import time
+_PROCESS_STARTED = time.perf_counter()
+
 import logging
 import os
 import json
 import random
-import time
 import datetime
-import aiohttp
 import asyncio
+import contextvars
 import copy
+import functools
+import heapq
+import logging.handlers
+import queue
+import csv
+import re
+from collections import deque
 from io import BytesIO
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     LabeledPrice
 )
 from telegram.ext import (
@@ -28,9 +38,8 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 import atexit
-from threading import Timer, Thread
-from flask import Flask
-import requests
+from threading import Event, Timer, Thread
+# flask, requests и aiohttp импортируются лениво — при первом использовании (см. run_flask, ocr_from_bytes, ask_ai)
 
 # -------------- Load env ----------------
 load_dotenv()
@@ -45,14 +54,203 @@ TELEGRAM_PAYMENT_PROVIDER_TOKEN = os.getenv("TELEGRAM_PAYMENT_PROVIDER_TOKEN")
 OCR_API_KEY = os.getenv("OCR_API_KEY")  # Optional: OCR.space key
 OWNER_PAYMENT_DETAILS = os.getenv("OWNER_PAYMENT_DETAILS", "Свяжитесь с владельцем для оплаты.")  # For manual payments
 FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "5"))
+USER_DATA_WAIT_TIMEOUT = float(os.getenv("USER_DATA_WAIT_TIMEOUT", "60"))  # сек ожидания фоновой загрузки user_data.json
+# Upstream endpoints — overridable for a local Bot API server or the load-test stubs (bench/loadtest.py)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")  # e.g. http://127.0.0.1:8081/bot
+TELEGRAM_FILE_BASE_URL = os.getenv("TELEGRAM_FILE_BASE_URL")  # e.g. http://127.0.0.1:8081/file/bot
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+OCR_API_URL = os.getenv("OCR_API_URL", "https://api.ocr.space/parse/image")
 
 # -------------- Logging ------------------
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Записи уходят в ограниченную очередь и пишутся в stderr фоновым потоком (QueueListener),
+# поэтому обработчики не ждут вывода. Повторяющиеся предупреждения/ошибки сэмплируются.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_REPEAT_WINDOW = float(os.getenv("LOG_REPEAT_WINDOW", "60"))  # сек
+LOG_REPEAT_BURST = int(os.getenv("LOG_REPEAT_BURST", "5"))  # сколько одинаковых записей за окно пишем полностью
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))  # дальше — каждую N-ю
+STRUCTURED_FIELDS = ("user_id", "handler", "latency_ms", "update_id", "suppressed")
+
+# user_id/handler текущего апдейта — проставляются во все записи, сделанные внутри обработчика
+_log_context = contextvars.ContextVar("log_context", default=None)
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        ctx = _log_context.get()
+        if ctx:
+            for key, value in ctx.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+class RepeatSampler(logging.Filter):
+    # Одинаковые записи (logger + уровень + шаблон сообщения + тип исключения) уровня WARNING и выше:
+    # первые LOG_REPEAT_BURST за окно проходят, затем каждая LOG_SAMPLE_EVERY-я с полем suppressed
+    def __init__(self):
+        super().__init__()
+        self._seen = {}  # key -> [window_start, count, suppressed]
+
+    @staticmethod
+    def _exception_type(record):
+        # Общие шаблоны вроде "OCR exception: %s" не должны прятать новый тип ошибки за старым
+        if record.exc_info and record.exc_info[0]:
+            return record.exc_info[0].__name__
+        if isinstance(record.args, tuple):
+            for arg in record.args:
+                if isinstance(arg, BaseException):
+                    return type(arg).__name__
+        return None
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg, self._exception_type(record))
+        now = time.monotonic()
+        entry = self._seen.get(key)
+        if entry is None or now - entry[0] > LOG_REPEAT_WINDOW:
+            suppressed = entry[2] if entry else 0
+            self._seen[key] = [now, 1, 0]
+            if len(self._seen) > 1000:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] <= LOG_REPEAT_WINDOW}
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        entry[1] += 1
+        if entry[1] <= LOG_REPEAT_BURST or entry[1] % LOG_SAMPLE_EVERY == 0:
+            if entry[2]:
+                record.suppressed = entry[2]
+                entry[2] = 0
+            return True
+        entry[2] += 1
+        return False
+
+# Такие аргументы можно форматировать позже, в потоке QueueListener
+_LOG_IMMUTABLE_ARGS = (str, int, float, bytes, type(None), BaseException)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0      # всего потеряно записей (видно в /health и /ready)
+        self._unreported = 0  # потеряно с момента последнего сообщения об этом в лог
+
+    def prepare(self, record):
+        # Не форматируем в потоке обработчика: сообщение и трейсбек соберёт QueueListener.
+        # Исключение — изменяемые аргументы (dict, list...): к моменту форматирования их могли
+        # поменять другие потоки, поэтому такие сообщения фиксируем сразу (фильтры уже отработали).
+        # Единственный аргумент-словарь LogRecord кладёт прямо в args.
+        if isinstance(record.args, dict) or not all(isinstance(arg, _LOG_IMMUTABLE_ARGS) for arg in record.args or ()):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def _dropped_record(self, count):
+        return logging.makeLogRecord({
+            "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+            "msg": "Очередь логов переполнена, потеряно записей: %s (всего %s)", "args": (count, self.dropped)
+        })
+
+    def enqueue(self, record):
+        try:
+            # Как только в очереди появилось место — сначала сообщаем, сколько записей потеряли
+            if self._unreported:
+                self.queue.put_nowait(self._dropped_record(self._unreported))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+    def report_dropped(self):
+        # При остановке: очередь уже разобрана слушателем, пишем итог напрямую
+        if self._unreported:
+            record = self._dropped_record(self._unreported)
+            self._unreported = 0
+            return record
+        return None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RepeatSampler())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет строку на каждый запрос к Bot API (включая long polling)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    def stop_listener():
+        listener.stop()
+        record = queue_handler.report_dropped()
+        if record:
+            stream_handler.handle(record)
+    atexit.register(stop_listener)
+    return queue_handler
+
+log_queue_handler = setup_logging()
 logger = logging.getLogger(__name__)
 
+def instrumented(callback):
+    # Оборачивает обработчик: контекст user_id/handler для логов и запись с latency_ms по завершении
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = getattr(update, "effective_user", None)
+        fields = {"handler": callback.__name__, "user_id": user.id if user else None,
+                  "update_id": getattr(update, "update_id", None)}
+        token = _log_context.set(fields)
+        started = time.perf_counter()
+        try:
+            if not user_manager.ready:
+                # Ждём фоновую загрузку данных в потоке, не блокируя цикл событий
+                if not await asyncio.to_thread(user_manager.wait_ready, USER_DATA_WAIT_TIMEOUT):
+                    message = getattr(update, "effective_message", None)
+                    if message:
+                        await message.reply_text("⏳ Бот запускается, попробуйте через минуту.")
+                    return None
+            return await callback(update, context)
+        finally:
+            logger.info("handled", extra={"latency_ms": round((time.perf_counter() - started) * 1000, 1)})
+            _log_context.reset(token)
+    return wrapper
+
+# -------------- Startup timing & readiness --------------
+# Секунды от старта процесса до каждого этапа; отдаются на /ready и пишутся в лог
+STARTUP_TIMINGS = {}
+_bot_initialized = Event()
+
+def mark_startup(stage: str):
+    STARTUP_TIMINGS[stage] = round(time.perf_counter() - _PROCESS_STARTED, 3)
+    if is_ready() and "ready" not in STARTUP_TIMINGS:
+        STARTUP_TIMINGS["ready"] = STARTUP_TIMINGS[stage]
+        logger.info("Бот готов к работе, этапы старта (с): %s", STARTUP_TIMINGS)
+
+def is_ready() -> bool:
+    return _bot_initialized.is_set() and user_manager.ready
+
 # -------------- User data manager (improved) -------------
 class UserDataManager:
     _instance = None
@@ -60,22 +258,72 @@ class UserDataManager:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._instance.data = cls._load_data()
+            cls._instance._data = {}
+            cls._instance._loaded = Event()
+            cls._instance._loader = None
+            cls._instance.load_failed = False
             cls._instance.lock = False
         return cls._instance
 
+    # user_data.json читается в фоновом потоке (start_loading), чтобы polling стартовал сразу.
+    # Обработчики дожидаются загрузки асинхронно (см. instrumented); здесь — только страховка
+    # для остальных путей, с ограниченным ожиданием.
+    @property
+    def data(self):
+        if not self._loaded.is_set() and not self.wait_ready(USER_DATA_WAIT_TIMEOUT):
+            raise RuntimeError("Данные пользователей ещё не загружены")
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded.is_set()
+
+    def start_loading(self):
+        if self._loader is None:
+            self._loader = Thread(target=self._load_in_background, name="user-data-loader", daemon=True)
+            self._loader.start()
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        self.start_loading()
+        return self._loaded.wait(timeout)
+
+    def _load_in_background(self):
+        started = time.perf_counter()
+        try:
+            self._data = self._load_data()
+            logger.info("Данные пользователей загружены: %s за %.2f с", len(self._data), time.perf_counter() - started)
+        except Exception:
+            # Файлы есть, но не читаются — работаем с пустой базой и не сохраняем, чтобы не затереть их
+            self._data = {}
+            self.load_failed = True
+            logger.exception("Не удалось загрузить данные пользователей, сохранение отключено")
+        finally:
+            self._loaded.set()
+        mark_startup("user_data_loaded")
+
     @staticmethod
     def _load_data():
+        error = None
         for file_path in [USER_DATA_FILE, BACKUP_FILE]:
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
                     return json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
+            except FileNotFoundError:
                 continue
+            except (OSError, ValueError) as e:  # JSONDecodeError, UnicodeDecodeError, PermissionError...
+                logger.error("Не удалось прочитать %s: %s", file_path, e)
+                error = e
+        if error is not None:
+            raise error
         return {}
 
     def save(self):
-        if self.lock:
+        # До окончания загрузки (или после неудачной) сохранять нельзя — иначе перезапишем файл пустым словарём
+        if self.lock or not self._loaded.is_set() or self.load_failed:
             return
         self.lock = True
         try:
@@ -86,7 +334,7 @@ class UserDataManager:
                 os.replace(USER_DATA_FILE, BACKUP_FILE)
             os.replace(temp_file, USER_DATA_FILE)
         except Exception as e:
-            logger.error(f"Ошибка сохранения: {e}")
+            logger.error("Ошибка сохранения: %s", e)
         finally:
             self.lock = False
 
@@ -154,6 +402,7 @@ class UserDataManager:
             new_until = current_until + days * 86400
         self.data[user_id]["premium_until"] = new_until
         self.save()
+        premium_scheduler.schedule(user_id, new_until)
 
     def is_premium(self, user_id: str) -> bool:
         self.ensure_user(user_id)
@@ -176,6 +425,123 @@ class UserDataManager:
 
 user_manager = UserDataManager()
 
+# -------------- Premium expiry scheduler --------------
+PREMIUM_REMINDER_DAYS = int(os.getenv("PREMIUM_REMINDER_DAYS", "3"))
+
+class PremiumExpiryScheduler:
+    # Min-heap событий (when, user_id, kind, premium_until): O(log n) на событие вместо обхода всех
+    # пользователей. Продление кладёт новые события, а устаревшие не удаляются из кучи — они
+    # отбрасываются при извлечении, если premium_until пользователя с тех пор изменился.
+    # Отправленные уведомления помечаются в данных пользователя, поэтому после рестарта не повторяются.
+    def __init__(self):
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+
+    @staticmethod
+    def _events(user_id: str, until: int, user: dict, now: float, late_reminder: bool = False):
+        # late_reminder: ставить ли напоминание, время которого уже прошло (пропущено, пока бот
+        # был выключен). При выдаче премиума короче PREMIUM_REMINDER_DAYS напоминать сразу незачем.
+        if until <= 0 or until < now - 86400:
+            return  # давно истёкшие подписки не уведомляем задним числом
+        remind_at = until - PREMIUM_REMINDER_DAYS * 86400
+        if user.get("premium_reminded_until") != until and until > now and (late_reminder or remind_at > now):
+            yield (remind_at, user_id, "reminder", until)
+        if user.get("premium_expired_until") != until:
+            yield (until, user_id, "expired", until)
+
+    def schedule(self, user_id: str, until: int):
+        user = user_manager.get(user_id) or {}
+        for event in self._events(user_id, int(until), user, time.time()):
+            heapq.heappush(self._heap, event)
+        if self._wakeup:
+            self._wakeup.set()
+
+    def rebuild(self):
+        now = time.time()
+        heap = []
+        for user_id, user in user_manager.data.items():
+            heap.extend(self._events(user_id, int(user.get("premium_until", 0) or 0), user, now, late_reminder=True))
+        heapq.heapify(heap)
+        self._heap = heap
+        logger.info("Планировщик премиума: %s событий", len(heap))
+
+    async def start(self, bot):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        # Данные пользователей грузятся в фоне — дожидаемся их, не блокируя цикл событий
+        await asyncio.to_thread(user_manager.wait_ready)
+        self.rebuild()
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            changed = False
+            while self._heap and self._heap[0][0] <= now:
+                _, user_id, kind, until = heapq.heappop(self._heap)
+                try:
+                    changed = await self._notify(bot, user_id, kind, until) or changed
+                except Exception as e:
+                    logger.error("Ошибка уведомления о премиуме для %s: %s", user_id, e)
+            if changed:
+                # Один save() на всю пачку событий, а не на каждое: save() переписывает весь файл.
+                # Сохраняем в цикле событий, как и обработчики, — иначе json.dump в потоке
+                # гонялся бы с их изменениями user_manager.data.
+                user_manager.save()
+            # Спим до ближайшего события (не дольше часа) или до нового schedule()
+            timeout = min(self._heap[0][0] - now, 3600) if self._heap else 3600
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def _time_left(seconds: float) -> str:
+        # Опоздавшее напоминание (после рестарта) может прийти за часы или минуты до конца
+        if seconds >= 86400:
+            return f"{round(seconds / 86400)} дн."
+        if seconds >= 3600:
+            return f"{round(seconds / 3600)} ч."
+        return f"{max(1, round(seconds / 60))} мин."
+
+    async def _notify(self, bot, user_id: str, kind: str, until: int) -> bool:
+        # Возвращает True, если отметка об уведомлении изменилась и данные нужно сохранить
+        user = user_manager.get(user_id)
+        if not user or int(user.get("premium_until", 0) or 0) != until:
+            return False  # подписку продлили или пользователь удалён — событие устарело
+        flag = "premium_reminded_until" if kind == "reminder" else "premium_expired_until"
+        if user.get(flag) == until:
+            return False
+        if kind == "reminder":
+            if until <= time.time():
+                return False  # напоминание опоздало — сразу придёт сообщение об окончании
+            readable = datetime.datetime.fromtimestamp(until).strftime("%Y-%m-%d %H:%M")
+            text = (f"⏳ Ваш премиум истекает {readable} (через {self._time_left(until - time.time())}). "
+                    f"Продлите, чтобы не потерять безлимит.")
+        else:
+            text = f"⌛ Срок премиума истёк. Бесплатно доступно {FREE_DAILY_LIMIT} решений в день — продлите премиум для безлимита."
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("💳 Продлить (/buy)", callback_data="buy")]])
+        try:
+            await bot.send_message(chat_id=int(user_id), text=text, reply_markup=markup)
+        except Exception as e:
+            # Пользователь мог заблокировать бота — отмечаем всё равно, чтобы не повторять
+            logger.warning("Не удалось отправить уведомление о премиуме %s: %s", user_id, e)
+        user[flag] = until
+        return True
+
+premium_scheduler = PremiumExpiryScheduler()
+
 # -------------- Autosave --------------
 def auto_save():
     user_manager.save()
@@ -186,82 +552,487 @@ async def is_owner(user_id: int) -> bool:
     return user_id in OWNER_IDS
 
 # -------------- Subjects & Task bank --------------
-SUBJECTS = {
-    "math": "Математика",
-    "english": "Английский",
-    "history": "История",
-    "literature": "Литература"
-}
+# Банк задач лежит в TASKS_DIR: по файлу на предмет (<subject>.json или <subject>.csv).
+# JSON: {"name": "Математика", "order": 1, "topics": {"algebra": [{"text": "...", "difficulty": "easy"}, ...]}}
+# CSV: колонки topic,difficulty,text (название предмета = имя файла)
+TASKS_DIR = os.getenv("TASKS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tasks"))
+TASK_BANK_RELOAD_INTERVAL = float(os.getenv("TASK_BANK_RELOAD_INTERVAL", "5"))
+# id тем и заданий сохраняются здесь: кнопки в уже отправленных сообщениях ссылаются на них и после рестарта
+TASK_IDS_FILE = os.getenv("TASK_IDS_FILE", "task_ids.json")
+DIFFICULTIES = ("easy", "medium", "hard")
+SEARCH_STEM_LEN = 6  # грубый стемминг: "уравнение"/"уравнения" -> "уравне"
+
+def _search_terms(text: str) -> set:
+    return {w[:SEARCH_STEM_LEN] for w in re.findall(r"\w+", text.lower()) if len(w) > 1}
+
+class TaskBank:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._subjects = {}        # subject -> name, в порядке "order"
+        self._topics = {}          # topic_id -> (subject, topic)
+        self._subject_topics = {}  # subject -> [topic_id]
+        self._tasks = {}           # task_id -> {"id", "subject", "topic", "difficulty", "text"}
+        self._topic_tasks = {}     # topic_id -> [task_id]
+        self._index = {}           # term -> set(task_id)
+        # id выдаются монотонно и хранятся в TASK_IDS_FILE, чтобы старые кнопки не указывали на чужие
+        # задания ни после горячей перезагрузки, ни после рестарта (даже если в файл вставили задание)
+        self._topic_ids = {}       # (subject, topic) -> topic_id
+        self._task_ids = {}        # (subject, topic, text) -> task_id
+        self._next_topic_id = self._next_task_id = 1
+        self._ids_writable = True
+        self._parsed = {}          # file name -> последний успешно разобранный файл
+        self._signature = None
+        self._last_check = 0.0
+        self._load_ids()
+        self.reload()
+
+    def _load_ids(self):
+        try:
+            with open(TASK_IDS_FILE, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            self._topic_ids = {(subject, topic): int(tid) for subject, topic, tid in raw["topics"]}
+            self._task_ids = {(subject, topic, text): int(tid) for subject, topic, text, tid in raw["tasks"]}
+            self._next_topic_id = max(self._topic_ids.values(), default=0) + 1
+            self._next_task_id = max(self._task_ids.values(), default=0) + 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Нумерация с нуля переназначила бы старые id — не перезаписываем файл, пока его не починят
+            self._topic_ids, self._task_ids = {}, {}
+            self._ids_writable = False
+            logger.error("Не удалось прочитать %s, id заданий не сохраняются: %s", TASK_IDS_FILE, e)
 
-# Пример банка задач — расширяй по желанию
-TASK_BANK = {
-    "math": {
-        "algebra": [
-            "Решите уравнение: 2x + 5 = 17",
-            "Найдите корни квадратного уравнения: x^2 - 5x + 6 = 0"
-        ],
-        "geometry": [
-            "В треугольнике ABC угол A=60°, B=70°. Найдите C.",
-            "Найдите площадь круга радиуса 5."
-        ]
-    },
-    "english": {
-        "grammar": [
-            "Сделайте предложение в Past Simple: I (to go) to the store yesterday.",
-            "Употребите Present Perfect в предложении на тему 'travel'."
-        ],
-        "vocabulary": [
-            "Дай 10 слов по теме 'school' с переводом.",
-            "Составь 5 предложений с глаголом 'to improve'."
-        ]
-    },
-    "history": {
-        "middle_ages": [
-            "Опишите причины начала Столетней войны.",
-            "Кто такой Чингисхан? Кратко опишите."
-        ]
-    },
-    "literature": {
-        "poetry": [
-            "Проанализируй стихотворение (пример): 'Стих' — какие образы в нём используются?",
-        ]
-    }
+    def _save_ids(self):
+        if not self._ids_writable:
+            return
+        raw = {
+            "topics": [[subject, topic, tid] for (subject, topic), tid in self._topic_ids.items()],
+            "tasks": [[subject, topic, text, tid] for (subject, topic, text), tid in self._task_ids.items()],
+        }
+        try:
+            temp_file = f"{TASK_IDS_FILE}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(raw, f, indent=2, ensure_ascii=False)
+            os.replace(temp_file, TASK_IDS_FILE)
+        except OSError as e:
+            logger.error("Ошибка сохранения %s: %s", TASK_IDS_FILE, e)
+
+    def _scan(self):
+        try:
+            names = sorted(n for n in os.listdir(self.directory) if n.endswith((".json", ".csv")))
+        except FileNotFoundError:
+            return ()
+        signature = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue  # файл удалили/переименовали между listdir и stat (сохранение редактором)
+            signature.append((name, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    @staticmethod
+    def _parse_item(item):
+        if isinstance(item, str):
+            return item, "medium"
+        if isinstance(item, dict) and isinstance(item.get("text"), str):
+            return item["text"], str(item.get("difficulty", "medium"))
+        raise ValueError(f"задание должно быть строкой или объектом с полем text: {item!r}")
+
+    def _read_file(self, name: str):
+        path = os.path.join(self.directory, name)
+        subject = os.path.splitext(name)[0]
+        with open(path, 'r', encoding='utf-8') as f:
+            if name.endswith(".json"):
+                raw = json.load(f)
+                if not isinstance(raw, dict) or not isinstance(raw.get("topics", {}), dict):
+                    raise ValueError("ожидается объект с полем topics: {тема: [задания]}")
+                topics = {}
+                for topic, items in raw.get("topics", {}).items():
+                    if not isinstance(items, list):
+                        raise ValueError(f"тема {topic!r}: ожидается список заданий")
+                    topics[str(topic)] = [self._parse_item(item) for item in items]
+                order = raw.get("order", 100)
+                if not isinstance(order, (int, float)):
+                    raise ValueError("order должен быть числом")
+                return subject, str(raw.get("name", subject)), order, topics
+            topics = {}
+            for row in csv.DictReader(f):
+                if not row.get("topic") or not row.get("text"):
+                    raise ValueError(f"строка без topic/text: {row!r}")
+                topics.setdefault(row["topic"], []).append((row["text"], row.get("difficulty") or "medium"))
+            return subject, subject, 100, topics
+
+    def reload(self):
+        signature = self._scan()
+        self._signature = signature
+        self._last_check = time.monotonic()
+        loaded = []
+        parsed = {}
+        for name, _, _ in signature:
+            try:
+                parsed[name] = self._read_file(name)
+            except Exception as e:
+                # Битый файл — оставляем его прежнюю версию (если была), остальные предметы грузим
+                logger.error("Ошибка загрузки банка задач %s: %s", name, e)
+                if name not in self._parsed:
+                    continue
+                parsed[name] = self._parsed[name]
+            loaded.append(parsed[name])
+        self._parsed = parsed
+
+        subjects, topics, subject_topics, tasks, topic_tasks, index = {}, {}, {}, {}, {}, {}
+        known_ids = (self._next_topic_id, self._next_task_id)
+        for subject, name, _, subject_data in sorted(loaded, key=lambda x: (x[2], x[0])):
+            subjects[subject] = name
+            subject_topics[subject] = []
+            for topic, items in subject_data.items():
+                topic_id = self._topic_ids.get((subject, topic))
+                if topic_id is None:
+                    topic_id = self._topic_ids[(subject, topic)] = self._next_topic_id
+                    self._next_topic_id += 1
+                topics[topic_id] = (subject, topic)
+                subject_topics[subject].append(topic_id)
+                topic_tasks[topic_id] = []
+                for text, difficulty in items:
+                    task_id = self._task_ids.get((subject, topic, text))
+                    if task_id is None:
+                        task_id = self._task_ids[(subject, topic, text)] = self._next_task_id
+                        self._next_task_id += 1
+                    tasks[task_id] = {"id": task_id, "subject": subject, "topic": topic,
+                                      "difficulty": difficulty, "text": text}
+                    topic_tasks[topic_id].append(task_id)
+                    for term in _search_terms(text):
+                        index.setdefault(term, set()).add(task_id)
+
+        self._subjects, self._topics, self._subject_topics = subjects, topics, subject_topics
+        self._tasks, self._topic_tasks, self._index = tasks, topic_tasks, index
+        if (self._next_topic_id, self._next_task_id) != known_ids:
+            self._save_ids()
+        logger.info("Банк задач загружен: %s предметов, %s заданий", len(subjects), len(tasks))
+
+    def _maybe_reload(self):
+        if time.monotonic() - self._last_check < TASK_BANK_RELOAD_INTERVAL:
+            return
+        self._last_check = time.monotonic()
+        if self._scan() != self._signature:
+            self.reload()
+
+    def subjects(self) -> dict:
+        self._maybe_reload()
+        return self._subjects
+
+    def subject_name(self, subject: str, default: str = None):
+        return self.subjects().get(subject, default)
+
+    def topics(self, subject: str) -> list:
+        self._maybe_reload()
+        return [(tid, self._topics[tid][1]) for tid in self._subject_topics.get(subject, [])]
+
+    def topic(self, topic_id: int):
+        self._maybe_reload()
+        return self._topics.get(topic_id)
+
+    def find_topic(self, subject: str, topic: str):
+        self._maybe_reload()
+        for tid in self._subject_topics.get(subject, []):
+            if self._topics[tid][1].lower() == topic:
+                return tid
+        return None
+
+    def task(self, task_id: int):
+        self._maybe_reload()
+        return self._tasks.get(task_id)
+
+    def random_task(self, topic_id: int, difficulty: str = None):
+        self._maybe_reload()
+        ids = self._topic_tasks.get(topic_id, [])
+        if difficulty:
+            ids = [tid for tid in ids if self._tasks[tid]["difficulty"] == difficulty]
+        return self._tasks[random.choice(ids)] if ids else None
+
+    def search(self, query: str, limit: int = 5) -> list:
+        self._maybe_reload()
+        postings = [self._index.get(term, set()) for term in _search_terms(query)]
+        if not postings:
+            return []
+        # Сначала задания со всеми словами запроса, затем — по числу совпавших слов
+        hits = {}
+        for posting in postings:
+            for tid in posting:
+                hits[tid] = hits.get(tid, 0) + 1
+        ranked = sorted(hits, key=lambda tid: (-hits[tid], tid))
+        return [self._tasks[tid] for tid in ranked[:limit]]
+
+task_bank = TaskBank(TASKS_DIR)
+
+# -------------- Prompt building & token budgets --------------
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Бюджеты на команду: input_tokens — сколько токенов отдаём на текст пользователя/OCR,
+# max_tokens — потолок длины ответа (≈3 символа кириллицы на токен, чтобы влезть в 4096)
+COMMAND_BUDGETS = {
+    "task": {"input_tokens": 600, "max_tokens": 900},
+    "formula": {"input_tokens": 200, "max_tokens": 600},
+    "theorem": {"input_tokens": 200, "max_tokens": 800},
+    "search": {"input_tokens": 150, "max_tokens": 700},
+    "media": {"input_tokens": 1000, "max_tokens": 900},
+    "album": {"input_tokens": 2500, "max_tokens": 1500},
+    "solve_now": {"input_tokens": 600, "max_tokens": 900},
 }
+DEFAULT_BUDGET = {"input_tokens": 600, "max_tokens": 800}
+
+# Накопленная статистика токенов по командам: {command: {"calls", "prompt_tokens", "completion_tokens"}}
+TOKEN_USAGE = {}
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка без токенизатора: ~4 символа латиницы или ~2.5 символа кириллицы на токен
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_count = len(text) - non_ascii
+    return int(ascii_count / 4 + non_ascii / 2.5) + 1
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    while text and estimate_tokens(text) > max_tokens:
+        cut = int(len(text) * max_tokens / estimate_tokens(text) * 0.95)
+        cut_at_space = text.rfind(" ", 0, cut)
+        text = text[:cut_at_space if cut_at_space > cut // 2 else cut]
+    return text.rstrip() + " …"
+
+def clean_ocr_text(text: str) -> str:
+    # OCR.space возвращает \r\n, повторяющиеся пробелы и строки-мусор из рамок/линий
+    lines = []
+    for raw in text.replace("\r", "\n").split("\n"):
+        line = " ".join(raw.split())
+        if not line or not any(ch.isalnum() for ch in line):
+            continue
+        if lines and lines[-1] == line:
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+def prepare_input(command: str, text: str) -> str:
+    budget = COMMAND_BUDGETS.get(command, DEFAULT_BUDGET)
+    return trim_to_tokens(text.strip(), budget["input_tokens"])
+
+def record_token_usage(command: str, prompt_tokens: int, completion_tokens: int):
+    stats = TOKEN_USAGE.setdefault(command, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    stats["calls"] += 1
+    stats["prompt_tokens"] += prompt_tokens
+    stats["completion_tokens"] += completion_tokens
+    logger.info("Tokens [%s]: prompt=%s completion=%s", command, prompt_tokens, completion_tokens)
+
+async def reply_long(message, text: str):
+    for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+        await message.reply_text(text[i:i + TELEGRAM_MESSAGE_LIMIT])
+
+# -------------- Upstream resilience (circuit breakers & retry) --------------
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 0.5  # сек, база экспоненциальной задержки
+RETRY_MAX_DELAY = 8.0   # больше не ждём между попытками (и не ретраим, если Retry-After больше)
+# Таймаут одной попытки и общий дедлайн вызова (все попытки + паузы), сек
+AI_ATTEMPT_TIMEOUT = float(os.getenv("AI_ATTEMPT_TIMEOUT", "20"))
+AI_DEADLINE = float(os.getenv("AI_DEADLINE", "30"))
+OCR_ATTEMPT_TIMEOUT = float(os.getenv("OCR_ATTEMPT_TIMEOUT", "10"))
+OCR_DEADLINE = float(os.getenv("OCR_DEADLINE", "20"))
+MIN_ATTEMPT_TIMEOUT = 1.0  # если до дедлайна осталось меньше — новую попытку не начинаем
+
+class UpstreamUnavailable(Exception):
+    """Breaker открыт — запрос к сервису даже не отправлялся."""
+
+class RetryableError(Exception):
+    def __init__(self, reason: str, retry_after: float = None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+def parse_retry_after(value) -> float | None:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.transitions = deque(maxlen=20)  # (unix time, from, to, reason)
+
+    def _transition(self, state: str, reason: str):
+        self.transitions.append((time.time(), self.state, state, reason))
+        logger.warning("Circuit breaker %s: %s -> %s (%s)", self.name, self.state, state, reason)
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+
+    def retry_in(self) -> int:
+        return max(0, int(self.opened_at + self.recovery_timeout - time.monotonic()) + 1)
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self._transition(self.HALF_OPEN, "recovery timeout elapsed")
+        if self.state == self.HALF_OPEN:
+            # В half-open пропускаем одну пробную попытку, остальные сразу отбиваем
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    def rejects(self) -> bool:
+        # Как allow(), но без побочных эффектов: вызов сейчас точно будет отбит (для проверок заранее)
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at < self.recovery_timeout
+        return self.state == self.HALF_OPEN and self.probe_in_flight
+
+    def release_probe(self):
+        # Попытку отменили (CancelledError) — сервис не виноват, просто освобождаем пробный слот
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+            self._transition(self.CLOSED, "probe succeeded")
+
+    def record_failure(self, reason: str):
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+            self._transition(self.OPEN, f"probe failed: {reason}")
+            return
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._transition(self.OPEN, f"{self.failures} failures in a row, last: {reason}")
+
+openrouter_breaker = CircuitBreaker(
+    "openrouter",
+    failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+    recovery_timeout=float(os.getenv("BREAKER_RECOVERY_TIMEOUT", "30"))
+)
+ocr_breaker = CircuitBreaker(
+    "ocr",
+    failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+    recovery_timeout=float(os.getenv("BREAKER_RECOVERY_TIMEOUT", "30"))
+)
+BREAKERS = [openrouter_breaker, ocr_breaker]
+
+async def call_upstream(breaker: CircuitBreaker, request, attempt_timeout: float, deadline: float):
+    # request(timeout) возвращает результат или бросает RetryableError (сеть, таймаут, 429/5xx).
+    # Ретраим с "full jitter" экспоненциальной задержкой, уважая Retry-After, но не дольше deadline
+    # секунд на весь вызов. Любой исход попытки отмечается в breaker — иначе пробный запрос
+    # в half-open так и остался бы "в полёте".
+    deadline_at = time.monotonic() + deadline
+    for attempt in range(1, UPSTREAM_MAX_ATTEMPTS + 1):
+        remaining = deadline_at - time.monotonic()
+        if not breaker.allow():
+            raise UpstreamUnavailable(breaker.name)
+        try:
+            result = await request(min(attempt_timeout, remaining))
+        except RetryableError as e:
+            breaker.record_failure(str(e))
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if e.retry_after is not None:
+                delay = max(delay, e.retry_after)
+            if (attempt == UPSTREAM_MAX_ATTEMPTS or delay > RETRY_MAX_DELAY
+                    or deadline_at - time.monotonic() - delay < MIN_ATTEMPT_TIMEOUT):
+                raise
+            logger.warning("%s: %s, попытка %s/%s, повтор через %.1f с", breaker.name, e, attempt, UPSTREAM_MAX_ATTEMPTS, delay)
+            await asyncio.sleep(delay)
+            continue
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            # Неожиданный ответ (например, битый JSON при 200) — тоже сбой сервиса, но без повтора
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            raise
+        breaker.record_success()
+        return result
 
 # -------------- AI (OpenRouter) --------------
-async def ask_ai(prompt: str, context_text: str = "") -> str:
+async def ask_ai(prompt: str, context_text: str = "", command: str = None) -> tuple[str, bool]:
+    # Возвращает (текст, ok). При ok=False текст — сообщение об ошибке для пользователя,
+    # бесплатный запрос за него не списывается.
     if not OPENROUTER_API_KEY:
-        return "⚠️ OpenRouter API key не настроен."
+        return "⚠️ OpenRouter API key не настроен.", False
+    budget = COMMAND_BUDGETS.get(command, DEFAULT_BUDGET)
+    max_tokens = budget["max_tokens"]
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
+    system_text = (
+        "You are a helpful assistant, a teacher. "
+        f"Keep the answer under {max_tokens * 3} characters."
+    )
+    user_text = f"{context_text}\n\n{prompt}"
     payload = {
         "model": "openai/gpt-3.5-turbo",
         "messages": [
-            {"role": "system", "content": "You are a helpful assistant, a teacher."},
-            {"role": "user", "content": f"{context_text}\n\n{prompt}"}
-        ]
+            {"role": "system", "content": system_text},
+            {"role": "user", "content": user_text}
+        ],
+        "max_tokens": max_tokens
     }
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload, timeout=30) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                else:
+    import aiohttp
+
+    async def request(timeout):
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(OPENROUTER_API_URL, headers=headers, json=payload,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    if resp.status == 200:
+                        return await resp.json()
                     text = await resp.text()
-                    logger.error(f"OpenRouter error {resp.status}: {text}")
-                    return "⚠️ Ошибка при обращении к ИИ."
+                    if resp.status in RETRY_STATUSES:
+                        raise RetryableError(f"HTTP {resp.status}", parse_retry_after(resp.headers.get("Retry-After")))
+                    logger.error("OpenRouter error %s: %s", resp.status, text)
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RetryableError(f"{type(e).__name__}: {e}")
+
+    try:
+        data = await call_upstream(openrouter_breaker, request, AI_ATTEMPT_TIMEOUT, AI_DEADLINE)
+    except UpstreamUnavailable:
+        return f"⚠️ ИИ временно недоступен. Попробуйте через {openrouter_breaker.retry_in()} сек.", False
+    except RetryableError as e:
+        logger.error("OpenRouter unavailable after retries: %s", e)
+        return "⚠️ Не удалось связаться с ИИ.", False
     except Exception as e:
-        logger.error(f"ask_ai exception: {e}")
-        return "⚠️ Не удалось связаться с ИИ."
+        logger.error("ask_ai exception: %s", e)
+        return "⚠️ Не удалось связаться с ИИ.", False
+    if data is None:
+        return "⚠️ Ошибка при обращении к ИИ.", False
+    try:
+        answer = data["choices"][0]["message"]["content"].strip()
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        logger.error("OpenRouter unexpected response: %s", e)
+        return "⚠️ Ошибка при обращении к ИИ.", False
+    usage = data.get("usage") or {}
+    record_token_usage(
+        command or "other",
+        usage.get("prompt_tokens") or estimate_tokens(system_text + user_text),
+        usage.get("completion_tokens") or estimate_tokens(answer)
+    )
+    return answer, True
 
 # -------------- OCR (optional, OCR.space) --------------
 async def ocr_from_bytes(file_bytes: bytes) -> str | None:
     if not OCR_API_KEY:
         return None
-    url = "https://api.ocr.space/parse/image"
+    import requests
+    url = OCR_API_URL
     data = {
         "apikey": OCR_API_KEY,
         "language": "rus",
@@ -270,22 +1041,38 @@ async def ocr_from_bytes(file_bytes: bytes) -> str | None:
     files = {
         'file': ('image.jpg', file_bytes)
     }
+
+    async def request(timeout):
+        # Using requests because OCR.space doesn't need async; run it in executor so the loop isn't blocked
+        loop = asyncio.get_running_loop()
+        try:
+            resp = await loop.run_in_executor(
+                None, lambda: requests.post(url, data=data, files=files, timeout=timeout)
+            )
+        except requests.RequestException as e:
+            raise RetryableError(f"{type(e).__name__}: {e}")
+        if resp.status_code in RETRY_STATUSES:
+            raise RetryableError(f"HTTP {resp.status_code}", parse_retry_after(resp.headers.get("Retry-After")))
+        return resp
+
     try:
-        # Using requests because OCR.space doesn't need async; it's okay here
-        resp = requests.post(url, data=data, files=files, timeout=30)
+        resp = await call_upstream(ocr_breaker, request, OCR_ATTEMPT_TIMEOUT, OCR_DEADLINE)
         if resp.status_code == 200:
             result = resp.json()
             if result.get("IsErroredOnProcessing"):
-                logger.error(f"OCR error: {result}")
+                logger.error("OCR error: %s", result)
                 return None
             parsed = result.get("ParsedResults", [])
             text = "\n".join([p.get("ParsedText", "") for p in parsed])
             return text.strip()
         else:
-            logger.error(f"OCR request failed {resp.status_code}")
+            logger.error("OCR request failed %s", resp.status_code)
             return None
+    except UpstreamUnavailable:
+        logger.warning("OCR skipped: circuit breaker open, retry in %s s", ocr_breaker.retry_in())
+        return None
     except Exception as e:
-        logger.error(f"OCR exception: {e}")
+        logger.error("OCR exception: %s", e)
         return None
 
 # -------------- Registration & start --------------
@@ -334,7 +1121,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📚 Доступные команды:\n"
         "/start - Начать работу с ботом\n"
         "/subject - Выбрать предмет (Math, English, History, Literature)\n"
-        "/gettask - Получить задание по теме (интерактивно)\n"
+        "/gettask - Получить задание по теме (интерактивно) или найти: /gettask <слова>\n"
         "/task - Решить задачу (текстом)\n"
         "/formula - Объяснить формулу\n"
         "/theorem - Объяснить теорему\n"
@@ -348,6 +1135,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/list - Список учеников\n"
             "/broadcast - Рассылка сообщений\n"
             "/grant <user_id> <days> - Выдать премиум пользователю вручную\n"
+            "/health - Состояние ИИ/OCR и расход токенов\n"
         )
     await update.message.reply_text(help_text)
 
@@ -372,6 +1160,7 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     successful = 0
     failed = []
+    errors = {}  # тип ошибки -> количество; в лог уходит одна сводная запись, а не строка на каждого
     try:
         if update.message.text:
             for user_id in user_data:
@@ -380,7 +1169,7 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     successful += 1
                 except Exception as e:
                     failed.append(user_id)
-                    logger.error(f"Ошибка отправки для {user_id}: {e}")
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
         elif update.message.photo:
             photo = update.message.photo[-1].file_id
             caption = update.message.caption or ""
@@ -390,13 +1179,14 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     successful += 1
                 except Exception as e:
                     failed.append(user_id)
-                    logger.error(f"Ошибка отправки фото для {user_id}: {e}")
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
         report = f"✅ Рассылка завершена:\nОтправлено: {successful}\nНе удалось: {len(failed)}"
         if failed:
+            logger.warning("Рассылка: не доставлено %s из %s, ошибки: %s", len(failed), len(user_data), errors)
             report += f"\n\nОшибки у ID: {', '.join(failed[:5])}{'...' if len(failed) > 5 else ''}"
         await update.message.reply_text(report)
     except Exception as e:
-        logger.error(f"Ошибка рассылки: {e}")
+        logger.error("Ошибка рассылки: %s", e)
         await update.message.reply_text("⚠️ Произошла ошибка при рассылке")
     return ConversationHandler.END
 
@@ -416,9 +1206,7 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = ["📝 Список пользователей:"]
     for uid, d in user_data.items():
         message.append(f"👤 {d.get('full_name', 'Неизвестный')} (@{d.get('username','нет_username')}) ID: {uid}")
-    full_message = "\n".join(message)
-    for i in range(0, len(full_message), 4096):
-        await update.message.reply_text(full_message[i:i+4096])
+    await reply_long(update.message, "\n".join(message))
 
 # -------------- Status & Grant (premium) --------------
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -453,6 +1241,27 @@ async def grant_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_manager.add_premium_days(user_id, days)
     await update.message.reply_text(f"✅ Выдал премиум пользователю {user_id} на {days} дней")
 
+# -------------- Health (owners) --------------
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_owner(update.effective_user.id):
+        await update.message.reply_text("⛔ Доступ только для учителей")
+        return
+    lines = ["🩺 Состояние внешних сервисов:"]
+    for breaker in BREAKERS:
+        line = f"\n{breaker.name}: {breaker.state}, ошибок подряд: {breaker.failures}"
+        if breaker.state == CircuitBreaker.OPEN:
+            line += f", пробный запрос через {breaker.retry_in()} с"
+        lines.append(line)
+        for ts, old, new, reason in list(breaker.transitions)[-5:]:
+            when = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"  {when} {old} → {new} ({reason})")
+    lines.append(f"\nПотеряно записей лога (очередь переполнена): {log_queue_handler.dropped}")
+    if TOKEN_USAGE:
+        lines.append("\nТокены по командам:")
+        for command, stats in TOKEN_USAGE.items():
+            lines.append(f"  {command}: {stats['calls']} вызовов, prompt {stats['prompt_tokens']}, completion {stats['completion_tokens']}")
+    await reply_long(update.message, "\n".join(lines))
+
 # -------------- Payments: /buy (telegram or manual) --------------
 async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -481,11 +1290,11 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 start_parameter="buy_premium"
             )
         except Exception as e:
-            logger.error(f"send_invoice error: {e}")
-            await update.message.reply_text("⚠️ Не удалось отправить счет. Проверьте настройки платежного провайдера.")
+            logger.error("send_invoice error: %s", e)
+            await update.effective_message.reply_text("⚠️ Не удалось отправить счет. Проверьте настройки платежного провайдера.")
     else:
         # Manual flow
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             "⚠️ Telegram Payments не настроены.\n\n"
             "Инструкция для ручной оплаты:\n"
             f"{OWNER_PAYMENT_DETAILS}\n\n"
@@ -495,6 +1304,11 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # set flag in context.user_data so that next photo will be handled as payment screenshot
         context.user_data["awaiting_payment_screenshot"] = True
 
+async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Кнопка "Продлить" из напоминания о премиуме
+    await update.callback_query.answer()
+    await buy_command(update, context)
+
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.pre_checkout_query
     await query.answer(ok=True)
@@ -519,7 +1333,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await context.bot.send_message(owner, f"Пользователь @{user.username} ({uid}) сообщает о платеже. Проверьте скриншот в чате.")
         except Exception as e:
-            logger.error(f"notify owner error: {e}")
+            logger.error("notify owner error: %s", e)
 
 # -------------- Command handlers: task / formula / theorem / search (preserve) --------------
 async def task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -532,12 +1346,13 @@ async def task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_manager.can_use_free(uid):
         await update.message.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy или подождите до завтра.")
         return
-    task = " ".join(context.args)
+    task = prepare_input("task", " ".join(context.args))
     await update.message.reply_text("🔍 Решаю задачу...")
     prompt = f"Реши эту задачу по шагам: {task}"
-    response = await ask_ai(prompt, "Ты опытный преподаватель. Реши задачу подробно с объяснением каждого шага.")
-    user_manager.use_free(uid)
-    await update.message.reply_text(f"📚 Решение задачи:\n\n{response}")
+    response, ok = await ask_ai(prompt, "Ты опытный преподаватель. Реши задачу подробно с объяснением каждого шага.", command="task")
+    if ok:
+        user_manager.use_free(uid)
+    await reply_long(update.message, f"📚 Решение задачи:\n\n{response}")
 
 async def formula_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -549,11 +1364,12 @@ async def formula_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_manager.can_use_free(uid):
         await update.message.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy или подождите до завтра.")
         return
-    formula = " ".join(context.args)
+    formula = prepare_input("formula", " ".join(context.args))
     await update.message.reply_text("🔍 Объясняю формулу...")
-    response = await ask_ai(f"Объясни эту формулу: {formula}", "Ты опытный преподаватель. Объясни формулу простым языком с примерами.")
-    user_manager.use_free(uid)
-    await update.message.reply_text(f"📖 Объяснение формулы:\n\n{response}")
+    response, ok = await ask_ai(f"Объясни эту формулу: {formula}", "Ты опытный преподаватель. Объясни формулу простым языком с примерами.", command="formula")
+    if ok:
+        user_manager.use_free(uid)
+    await reply_long(update.message, f"📖 Объяснение формулы:\n\n{response}")
 
 async def theorem_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -565,11 +1381,12 @@ async def theorem_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_manager.can_use_free(uid):
         await update.message.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy или подождите до завтра.")
         return
-    theorem = " ".join(context.args)
+    theorem = prepare_input("theorem", " ".join(context.args))
     await update.message.reply_text("🔍 Объясняю теорему...")
-    response = await ask_ai(f"Объясни эту теорему: {theorem}", "Ты опытный преподаватель. Объясни теорему с доказательством и примерами.")
-    user_manager.use_free(uid)
-    await update.message.reply_text(f"📖 Объяснение теоремы:\n\n{response}")
+    response, ok = await ask_ai(f"Объясни эту теорему: {theorem}", "Ты опытный преподаватель. Объясни теорему с доказательством и примерами.", command="theorem")
+    if ok:
+        user_manager.use_free(uid)
+    await reply_long(update.message, f"📖 Объяснение теоремы:\n\n{response}")
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -581,11 +1398,12 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_manager.can_use_free(uid):
         await update.message.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy или подождите до завтра.")
         return
-    query = " ".join(context.args)
+    query = prepare_input("search", " ".join(context.args))
     await update.message.reply_text("🔍 Ищу информацию...")
-    response = await ask_ai(f"Найди информацию по запросу: {query}", "Ты опытный преподаватель. Дай развернутый ответ на запрос с примерами.")
-    user_manager.use_free(uid)
-    await update.message.reply_text(f"🔎 Результаты поиска:\n\n{response}")
+    response, ok = await ask_ai(f"Найди информацию по запросу: {query}", "Ты опытный преподаватель. Дай развернутый ответ на запрос с примерами.", command="search")
+    if ok:
+        user_manager.use_free(uid)
+    await reply_long(update.message, f"🔎 Результаты поиска:\n\n{response}")
 
 # -------------- Subject selection (/subject) --------------
 async def subject_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -593,7 +1411,7 @@ async def subject_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(user.id)
     user_manager.ensure_user(uid, user.full_name, user.username)
     buttons = []
-    for key, name in SUBJECTS.items():
+    for key, name in task_bank.subjects().items():
         buttons.append([InlineKeyboardButton(name, callback_data=f"subject_{key}")])
     markup = InlineKeyboardMarkup(buttons)
     await update.message.reply_text("Выберите предмет:", reply_markup=markup)
@@ -607,48 +1425,69 @@ async def subject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     key = data.split("_", 1)[1]
     uid = str(query.from_user.id)
     user_manager.set_subject(uid, key)
-    await query.edit_message_text(f"✅ Предмет установлен: {SUBJECTS.get(key,'Неизвестно')}\nИспользуйте /gettask чтобы получить задания по теме.")
+    await query.edit_message_text(f"✅ Предмет установлен: {task_bank.subject_name(key, 'Неизвестно')}\nИспользуйте /gettask чтобы получить задания по теме.")
 
 # -------------- Gettask flow (interactive) --------------
-# We'll use callback data "tasksub_<subject>" and "tasktopic_<subject>_<topic>"
+# Callback data: "tasksub_<subject>", "tasktopic_<topic_id>", "solve_now_<task_id>" (id из task_bank)
 async def gettask_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # If user provided args like /gettask math algebra, handle quickly
+    # /gettask math algebra [easy|medium|hard] — сразу задание; /gettask <слова> — поиск по тексту заданий
     args = context.args
-    if args and args[0].lower() in SUBJECTS:
+    if args and args[0].lower() in task_bank.subjects():
         subj = args[0].lower()
         # if topic provided
         if len(args) > 1:
-            topic = args[1].lower()
-            await send_task_by_subject_topic(update, context, subj, topic)
+            topic_id = task_bank.find_topic(subj, args[1].lower())
+            difficulty = args[2].lower() if len(args) > 2 and args[2].lower() in DIFFICULTIES else None
+            if topic_id is None:
+                await update.message.reply_text("Заданий по этой теме не найдено.")
+                return
+            await send_task_by_topic(update, context, topic_id, difficulty)
             return
+    elif args:
+        await search_tasks(update, " ".join(args))
+        return
     # else interactive list subjects
     buttons = []
-    for key, name in SUBJECTS.items():
+    for key, name in task_bank.subjects().items():
         buttons.append([InlineKeyboardButton(name, callback_data=f"tasksub_{key}")])
     await update.message.reply_text("Выберите предмет для задания:", reply_markup=InlineKeyboardMarkup(buttons))
 
+async def search_tasks(update: Update, query: str):
+    found = task_bank.search(query)
+    if not found:
+        await update.message.reply_text("Заданий по запросу не найдено.")
+        return
+    lines = [f"🔎 Найдено заданий: {len(found)}"]
+    buttons = []
+    for i, task in enumerate(found, 1):
+        lines.append(f"\n{i}. [{task_bank.subject_name(task['subject'], task['subject'])} / {task['topic']}] {task['text']}")
+        buttons.append([InlineKeyboardButton(f"Решить №{i}", callback_data=f"solve_now_{task['id']}")])
+    await update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(buttons))
+
 async def tasksub_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     data = q.data  # tasksub_math
     subj = data.split("_", 1)[1]
-    topics = TASK_BANK.get(subj, {}).keys()
+    topics = task_bank.topics(subj)
     if not topics:
         await q.edit_message_text("К сожалению, для этого предмета нет заданий.")
         return
     buttons = []
-    for t in topics:
-        buttons.append([InlineKeyboardButton(t, callback_data=f"tasktopic_{subj}_{t}")])
-    await q.edit_message_text(f"Выбран предмет: {SUBJECTS.get(subj)}\nВыберите тему:", reply_markup=InlineKeyboardMarkup(buttons))
+    for topic_id, t in topics:
+        buttons.append([InlineKeyboardButton(t, callback_data=f"tasktopic_{topic_id}")])
+    await q.edit_message_text(f"Выбран предмет: {task_bank.subject_name(subj)}\nВыберите тему:", reply_markup=InlineKeyboardMarkup(buttons))
 
 async def tasktopic_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    data = q.data  # tasktopic_math_algebra
-    _, subj, topic = data.split("_", 2)
-    await send_task_by_subject_topic(q, context, subj, topic)
+    try:
+        topic_id = int(q.data.split("_", 1)[1])  # tasktopic_3
+    except ValueError:
+        return
+    await send_task_by_topic(q, context, topic_id)
 
-async def send_task_by_subject_topic(trigger, context, subj, topic):
+async def send_task_by_topic(trigger, context, topic_id, difficulty=None):
     # trigger can be Update or CallbackQuery; unify
     if isinstance(trigger, Update):
         send_to = trigger.message
@@ -658,20 +1497,23 @@ async def send_task_by_subject_topic(trigger, context, subj, topic):
         send_to = trigger
         uid = str(trigger.from_user.id)
 
-    tasks = TASK_BANK.get(subj, {}).get(topic, [])
-    if not tasks:
-        await send_to.edit_message_text("Заданий по этой теме не найдено.")
+    task = task_bank.random_task(topic_id, difficulty)
+    if not task:
+        try:
+            await send_to.edit_message_text("Заданий по этой теме не найдено.")
+        except Exception:
+            await context.bot.send_message(chat_id=int(uid), text="Заданий по этой теме не найдено.")
         return
 
-    task = random.choice(tasks)
     # Provide a button to solve task
     buttons = [
-        [InlineKeyboardButton("Решить (бот)", callback_data=f"solve_now_{subj}_{topic}")],
-        [InlineKeyboardButton("Получить другое задание", callback_data=f"tasktopic_{subj}_{topic}")]
+        [InlineKeyboardButton("Решить (бот)", callback_data=f"solve_now_{task['id']}")],
+        [InlineKeyboardButton("Получить другое задание", callback_data=f"tasktopic_{topic_id}")]
     ]
-    text = f"📘 Предмет: {SUBJECTS.get(subj)}\n📚 Тема: {topic}\n\nЗадание:\n{task}"
-    if isinstance(send_to, type(trigger)):  # shouldn't happen
-        pass
+    text = (
+        f"📘 Предмет: {task_bank.subject_name(task['subject'])}\n📚 Тема: {task['topic']}\n"
+        f"Сложность: {task['difficulty']}\n\nЗадание:\n{task['text']}"
+    )
     # If called from callback query:
     try:
         await send_to.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
@@ -682,22 +1524,32 @@ async def send_task_by_subject_topic(trigger, context, subj, topic):
 async def solve_now_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    _, subj, topic = q.data.split("_", 2)
-    tasks = TASK_BANK.get(subj, {}).get(topic, [])
-    if not tasks:
+    try:
+        task = task_bank.task(int(q.data.rsplit("_", 1)[1]))  # solve_now_17
+    except ValueError:
+        task = None
+    if not task:
         await q.edit_message_text("Нет доступных заданий для решения.")
         return
-    task = random.choice(tasks)
-    await q.edit_message_text(f"🔎 Решаю задание:\n\n{task}")
+    await q.edit_message_text(f"🔎 Решаю задание:\n\n{task['text']}")
     uid = str(q.from_user.id)
     if not user_manager.can_use_free(uid):
         await q.edit_message_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy.")
         return
-    response = await ask_ai(f"Реши по шагам: {task}", f"Предмет: {SUBJECTS.get(subj)}")
-    user_manager.use_free(uid)
-    await q.message.reply_text(f"✅ Решение:\n\n{response}")
+    response, ok = await ask_ai(f"Реши по шагам: {prepare_input('solve_now', task['text'])}", f"Предмет: {task_bank.subject_name(task['subject'])}", command="solve_now")
+    if ok:
+        user_manager.use_free(uid)
+    await reply_long(q.message, f"✅ Решение:\n\n{response}")
 
 # -------------- Media handler (improved) --------------
+# Фото из одного альбома (media_group_id) приходят отдельными апдейтами — собираем их
+# MEDIA_GROUP_WINDOW секунд после последнего фото и решаем одним запросом к ИИ
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.5"))
+# Длинный ответ отправляем файлом, а не пачкой сообщений по 4096 символов
+LONG_ANSWER_AS_DOCUMENT = os.getenv("LONG_ANSWER_AS_DOCUMENT", "1") == "1"
+
+_media_groups = {}  # media_group_id -> {"messages": [...], "last_seen": monotonic, "task": asyncio.Task}
+
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if not update.message.photo:
@@ -706,9 +1558,11 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         uid = str(user.id)
         user_manager.ensure_user(uid, user.full_name, user.username)
+        group_id = update.message.media_group_id
 
         # If user was in manual payment flow and expects to send payment screenshot
-        if context.user_data.get("awaiting_payment_screenshot"):
+        awaiting_payment = context.user_data.get("awaiting_payment_screenshot")
+        if awaiting_payment or (group_id and context.user_data.get("payment_media_group") == group_id):
             # forward to owners and notify
             photo = update.message.photo[-1].file_id
             caption = update.message.caption or ""
@@ -717,67 +1571,153 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 try:
                     await context.bot.send_photo(chat_id=owner, photo=photo, caption=msg)
                 except Exception as e:
-                    logger.error(f"Error forwarding payment screenshot: {e}")
-            context.user_data["awaiting_payment_screenshot"] = False
-            await update.message.reply_text("✅ Скриншот отправлен администраторам. После проверки вам вручат премиум (через /grant).")
+                    logger.error("Error forwarding payment screenshot: %s", e)
+            if awaiting_payment:
+                context.user_data["awaiting_payment_screenshot"] = False
+                context.user_data["payment_media_group"] = group_id
+                await update.message.reply_text("✅ Скриншот отправлен администраторам. После проверки вам вручат премиум (через /grant).")
             return
 
-        # Workflow: try OCR if possible -> if recognized text -> ask AI to solve -> else forward to teachers
-        photo_file = await update.message.photo[-1].get_file()
-        b = BytesIO()
-        await photo_file.download_to_memory(out=b)
-        file_bytes = b.getvalue()
-
-        ocr_text = None
-        if OCR_API_KEY:
-            await update.message.reply_text("🔎 Пытаюсь распознать текст на фото...")
-            loop = asyncio.get_event_loop()
-            # OCR uses blocking requests internally, run in executor
-            ocr_text = await loop.run_in_executor(None, ocr_from_bytes, file_bytes)
-        if ocr_text:
-            await update.message.reply_text("🧾 Текст распознан. Отправляю на решение...")
-            # send to AI with subject context if present
-            subj_key = user_manager.get(uid).get("subject")
-            subj_name = SUBJECTS.get(subj_key, "Не указан") if subj_key else "Не указан"
-            prompt = f"Реши задачу по шагам. Предмет: {subj_name}. Задача:\n{ocr_text}"
-            if not user_manager.can_use_free(uid):
-                await update.message.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy.")
-                return
-            response = await ask_ai(prompt, "Ты опытный преподаватель. Реши подробно с объяснениями.")
-            user_manager.use_free(uid)
-            await update.message.reply_text(f"📚 Решение:\n\n{response}")
+        if group_id:
+            group = _media_groups.setdefault(group_id, {"messages": [], "task": None})
+            group["messages"].append(update.message)
+            group["last_seen"] = time.monotonic()
+            if group["task"] is None:
+                group["task"] = asyncio.create_task(collect_media_group(group_id, context))
             return
-        else:
-            # fallback: forward photo to teachers (old behavior)
-            user_info = user_manager.get(uid)
-            base_caption = f"📩 От ученика {user_info.get('full_name','Неизвестный')}\n@{user_info.get('username','нет_username')}"
-            full_caption = base_caption
-            if update.message.caption:
-                full_caption += f"\n\n{update.message.caption}"
-            for teacher_id in OWNER_IDS:
-                try:
-                    await context.bot.send_photo(chat_id=teacher_id, photo=update.message.photo[-1].file_id, caption=full_caption if full_caption else None)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки учителю {teacher_id}: {e}")
-            await update.message.reply_text("✅ Ваше фото отправлено учителям (распознавание не сработало).")
+
+        await solve_photos([update.message], context)
     except Exception as e:
-        logger.error(f"Ошибка handle_media: {e}")
+        logger.error("Ошибка handle_media: %s", e)
         await update.message.reply_text("⚠️ Произошла ошибка при обработке фото.")
 
+async def collect_media_group(group_id, context):
+    group = _media_groups[group_id]
+    while (wait := group["last_seen"] + MEDIA_GROUP_WINDOW - time.monotonic()) > 0:
+        await asyncio.sleep(wait)
+    _media_groups.pop(group_id, None)
+    messages = sorted(group["messages"], key=lambda m: m.message_id)
+    try:
+        await solve_photos(messages, context)
+    except Exception as e:
+        logger.error("Ошибка обработки альбома %s: %s", group_id, e)
+        await messages[0].reply_text("⚠️ Произошла ошибка при обработке фото.")
+
+async def download_photo(message) -> bytes:
+    photo_file = await message.photo[-1].get_file()
+    b = BytesIO()
+    await photo_file.download_to_memory(out=b)
+    return b.getvalue()
+
+async def solve_photos(messages, context):
+    # Workflow: try OCR if possible -> if recognized text -> ask AI to solve -> else forward to teachers.
+    # Для альбома страницы скачиваются и распознаются параллельно, решение — одним запросом.
+    first = messages[0]
+    uid = str(first.from_user.id)
+    album = len(messages) > 1
+
+    pages = []
+    # OCR недоступен (breaker открыт) — не скачиваем фото зря, сразу отправляем учителям
+    if OCR_API_KEY and not ocr_breaker.rejects():
+        # Лимит проверяем до скачивания и OCR: альбом из 10 фото — это 10 платных запросов к OCR.space
+        if not user_manager.can_use_free(uid):
+            await first.reply_text("💳 Вы использовали все бесплатные запросы. Купите премиум через /buy.")
+            return
+        await first.reply_text(f"🔎 Пытаюсь распознать текст на {len(messages)} фото..." if album else "🔎 Пытаюсь распознать текст на фото...")
+        files = await asyncio.gather(*(download_photo(m) for m in messages))
+        texts = await asyncio.gather(*(ocr_from_bytes(f) for f in files))
+        budget = COMMAND_BUDGETS["album" if album else "media"]["input_tokens"] // len(messages)
+        pages = [trim_to_tokens(clean_ocr_text(t), budget) if t else "" for t in texts]
+
+    if not any(pages):
+        # fallback: forward photo to teachers (old behavior)
+        await forward_to_teachers(messages, uid, context)
+        await first.reply_text("✅ Ваше фото отправлено учителям (распознавание не сработало).")
+        return
+
+    await first.reply_text("🧾 Текст распознан. Отправляю на решение...")
+    # send to AI with subject context if present
+    subj_key = user_manager.get(uid).get("subject")
+    subj_name = task_bank.subject_name(subj_key, "Не указан") if subj_key else "Не указан"
+    if album:
+        body = "\n\n".join(f"Страница {i}:\n{text}" for i, text in enumerate(pages, 1) if text)
+        prompt = f"Реши по шагам все задачи со страниц. Предмет: {subj_name}. Задачи:\n\n{body}"
+    else:
+        prompt = f"Реши задачу по шагам. Предмет: {subj_name}. Задача:\n{pages[0]}"
+    response, ok = await ask_ai(prompt, "Ты опытный преподаватель. Реши подробно с объяснениями.", command="album" if album else "media")
+    if ok:
+        user_manager.use_free(uid)
+    missed = [str(i) for i, text in enumerate(pages, 1) if not text]
+    if missed:
+        response += f"\n\n⚠️ Не удалось распознать страницы: {', '.join(missed)}"
+    await send_answer(first, "📚 Решение", response)
+
+async def send_answer(message, header: str, response: str):
+    text = f"{header}:\n\n{response}"
+    if LONG_ANSWER_AS_DOCUMENT and len(text) > TELEGRAM_MESSAGE_LIMIT:
+        document = BytesIO(response.encode("utf-8"))
+        document.name = "solution.txt"
+        await message.reply_document(document=document, caption=f"{header} — ответ длинный, отправляю файлом.")
+        return
+    await reply_long(message, text)
+
+async def forward_to_teachers(messages, uid, context):
+    user_info = user_manager.get(uid)
+    full_caption = f"📩 От ученика {user_info.get('full_name','Неизвестный')}\n@{user_info.get('username','нет_username')}"
+    caption = next((m.caption for m in messages if m.caption), None)
+    if caption:
+        full_caption += f"\n\n{caption}"
+    for teacher_id in OWNER_IDS:
+        try:
+            if len(messages) > 1:
+                media = [InputMediaPhoto(m.photo[-1].file_id, caption=full_caption if i == 0 else None)
+                         for i, m in enumerate(messages[:10])]
+                await context.bot.send_media_group(chat_id=teacher_id, media=media)
+            else:
+                await context.bot.send_photo(chat_id=teacher_id, photo=messages[0].photo[-1].file_id, caption=full_caption)
+        except Exception as e:
+            logger.error("Ошибка отправки учителю %s: %s", teacher_id, e)
+
 # -------------- Error handler --------------
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    # Без repr всего Update — только id апдейта и пользователя
+    user = getattr(update, "effective_user", None)
+    logger.error(
+        "Update caused error: %s", context.error, exc_info=context.error,
+        extra={"update_id": getattr(update, "update_id", None), "user_id": user.id if user else None}
+    )
 
 # -------------- App start (Flask ping kept) --------------
-app_flask = Flask(__name__)
+def create_flask_app():
+    from flask import Flask, jsonify
+
+    app_flask = Flask(__name__)
+
+    @app_flask.route('/')
+    def flask_home():
+        return "Telegram Bot is running!"
+
+    @app_flask.route('/ready')
+    def flask_ready():
+        # 200 когда бот инициализирован и данные пользователей загружены, иначе 503
+        ready = is_ready()
+        return jsonify({
+            "ready": ready,
+            "user_data_load_failed": user_manager.load_failed,
+            "log_records_dropped": log_queue_handler.dropped,
+            "startup_timings": STARTUP_TIMINGS
+        }), 200 if ready else 503
 
-@app_flask.route('/')
-def flask_home():
-    return "Telegram Bot is running!"
+    return app_flask
 
 def run_flask():
+    # Flask импортируется здесь, в фоновом потоке, а не при импорте модуля
+    app_flask = create_flask_app()
+    mark_startup("flask_started")
     # Optional auto-ping for Replit; keep original behavior but safe
     if os.environ.get('REPL_SLUG'):
+        import requests
+
         def safe_ping():
             try:
                 delay = random.randint(600, 900)
@@ -785,61 +1725,79 @@ def run_flask():
                 url = f"https://{os.environ['REPL_SLUG']}.{os.environ['REPL_OWNER']}.repl.co"
                 requests.get(url, timeout=5)
             except Exception as e:
-                logger.error(f"Ping failed: {e}")
+                logger.error("Ping failed: %s", e)
             finally:
                 Timer(1, safe_ping).start()
         Timer(60, safe_ping).start()
     app_flask.run(host='0.0.0.0', port=int(os.getenv("PORT", "8080")))
 
+async def post_init(application):
+    _bot_initialized.set()
+    mark_startup("bot_initialized")
+    await premium_scheduler.start(application.bot)
+
+async def post_shutdown(application):
+    await premium_scheduler.stop()
+
 # -------------- Main --------------
 def main():
+    mark_startup("imports")
+    user_manager.start_loading()
     Thread(target=run_flask, daemon=True).start()
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    builder = ApplicationBuilder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    if TELEGRAM_FILE_BASE_URL:
+        builder = builder.base_file_url(TELEGRAM_FILE_BASE_URL)
+    app = builder.build()
 
     # Existing handlers
-    app.add_handler(MessageHandler(filters.PHOTO, handle_media))
+    app.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_media)))
 
     # Broadcast
     app.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("broadcast", broadcast_command)],
+        entry_points=[CommandHandler("broadcast", instrumented(broadcast_command))],
         states={
             BROADCAST: [
-                MessageHandler(filters.TEXT | filters.PHOTO, handle_broadcast),
-                CommandHandler("cancel", cancel_broadcast)
+                MessageHandler(filters.TEXT | filters.PHOTO, instrumented(handle_broadcast)),
+                CommandHandler("cancel", instrumented(cancel_broadcast))
             ]
         },
-        fallbacks=[CommandHandler("cancel", cancel_broadcast)]
+        fallbacks=[CommandHandler("cancel", instrumented(cancel_broadcast))]
     ))
 
     # Basic commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("task", task_command))
-    app.add_handler(CommandHandler("formula", formula_command))
-    app.add_handler(CommandHandler("theorem", theorem_command))
-    app.add_handler(CommandHandler("search", search_command))
-    app.add_handler(CommandHandler("list", list_command))
-    app.add_handler(CommandHandler("status", status_command))
-    app.add_handler(CommandHandler("grant", grant_command))
-    app.add_handler(CommandHandler("buy", buy_command))
-    app.add_handler(CommandHandler("confirm_payment", confirm_payment))
-    app.add_handler(CommandHandler("subject", subject_command))
-    app.add_handler(CommandHandler("gettask", gettask_command))
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("help", instrumented(help_command)))
+    app.add_handler(CommandHandler("task", instrumented(task_command)))
+    app.add_handler(CommandHandler("formula", instrumented(formula_command)))
+    app.add_handler(CommandHandler("theorem", instrumented(theorem_command)))
+    app.add_handler(CommandHandler("search", instrumented(search_command)))
+    app.add_handler(CommandHandler("list", instrumented(list_command)))
+    app.add_handler(CommandHandler("status", instrumented(status_command)))
+    app.add_handler(CommandHandler("grant", instrumented(grant_command)))
+    app.add_handler(CommandHandler("health", instrumented(health_command)))
+    app.add_handler(CommandHandler("buy", instrumented(buy_command)))
+    app.add_handler(CommandHandler("confirm_payment", instrumented(confirm_payment)))
+    app.add_handler(CommandHandler("subject", instrumented(subject_command)))
+    app.add_handler(CommandHandler("gettask", instrumented(gettask_command)))
 
     # Payment handlers (if using Telegram payments)
     if TELEGRAM_PAYMENT_PROVIDER_TOKEN:
-        app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+        app.add_handler(PreCheckoutQueryHandler(instrumented(precheckout_callback)))
+        app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, instrumented(successful_payment_callback)))
 
     # CallbackQuery handlers for subject selection and tasks
-    app.add_handler(CallbackQueryHandler(subject_callback, pattern=r"^subject_"))
-    app.add_handler(CallbackQueryHandler(tasksub_callback, pattern=r"^tasksub_"))
-    app.add_handler(CallbackQueryHandler(tasktopic_callback, pattern=r"^tasktopic_"))
-    app.add_handler(CallbackQueryHandler(solve_now_callback, pattern=r"^solve_now_"))
+    app.add_handler(CallbackQueryHandler(instrumented(subject_callback), pattern=r"^subject_"))
+    app.add_handler(CallbackQueryHandler(instrumented(tasksub_callback), pattern=r"^tasksub_"))
+    app.add_handler(CallbackQueryHandler(instrumented(tasktopic_callback), pattern=r"^tasktopic_"))
+    app.add_handler(CallbackQueryHandler(instrumented(solve_now_callback), pattern=r"^solve_now_"))
+    app.add_handler(CallbackQueryHandler(instrumented(buy_callback), pattern=r"^buy$"))
 
     # Error handler
     app.add_error_handler(error_handler)
+    mark_startup("handlers_registered")
 
     # Auto-save
     auto_save()